@@ -1,14 +1,17 @@
 # backend/api/admin_api.py
 from __future__ import annotations
-import os, json, datetime as dt, sqlite3
+import os, json, time, datetime as dt, sqlite3, threading, mmap, zipfile, itertools, asyncio
+import multiprocessing
 from pathlib import Path
-from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, BackgroundTasks
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from fastapi import APIRouter, Request, UploadFile, File, Form, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
 
 # Imports theo gói backend
-from backend.api.admin_auth import require_admin, make_token, ADMIN_USER, ADMIN_PASS
-from backend.rag.parser import parse_docx_as_table, infer_year_from_doc
+from backend.api.admin_auth import require_admin, make_token, check_admin_credentials
+from backend.rag.parser import parse_docx_as_table, parse_docx_as_table_iter
 from backend.ingest.ingest_lib import append_events, rebuild_events
-
 from fastapi import Query
 
 # Đường dẫn theo project_root
@@ -18,16 +21,98 @@ STORE_DIR    = os.getenv("STORE_DIR", str(PROJECT_ROOT / "rag_store"))
 DB_PATH      = str(Path(STORE_DIR) / "chunks.sqlite")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-router = APIRouter(prefix="/api/admin", tags=["admin"])
+# chặn upload quá cỡ (mặc định 25 MB) — tránh OOM vì POST khổng lồ
+MAX_UPLOAD = int(os.getenv("MAX_UPLOAD_BYTES", 25 * 1024 * 1024))
+
+# orjson serialize trực tiếp tuple/list từ SQLite, khỏi qua json.dumps chuẩn
+router = APIRouter(prefix="/api/admin", tags=["admin"], default_response_class=ORJSONResponse)
+
+# ===== SQLite: 1 connection/process, WAL + pragmas, DDL chạy đúng 1 lần =====
+_DDL = """CREATE TABLE IF NOT EXISTS uploads(
+  id INTEGER PRIMARY KEY,
+  filename TEXT, tag TEXT, mode TEXT, total_events INTEGER, added_events INTEGER,
+  status TEXT, log TEXT, created_at TEXT, updated_at TEXT)"""
+
+def _init_db() -> sqlite3.Connection:
+    """Chạy 1 lần cho mỗi process lúc mở connection đầu: mkdir + pragmas +
+    DDL + index. _log_upload/list_uploads không còn stat() thư mục hay check
+    schema nữa."""
+    Path(STORE_DIR).mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute(_DDL)
+    # index phục vụ filter theo tag + ORDER BY id DESC (phân trang)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_uploads_tag_id ON uploads(tag, id DESC)")
+    conn.commit()
+    return conn
+
+# connection mở lazy theo process (web process và từng worker tự mở riêng):
+# SQLite cấm dùng chung connection qua ranh giới process
+_CONN: sqlite3.Connection | None = None
+_DB_LOCK = threading.Lock()  # bảo vệ _CONN khi request + background task cùng ghi
+
+def _db() -> sqlite3.Connection:
+    # gọi bên trong _DB_LOCK
+    global _CONN
+    if _CONN is None:
+        _CONN = _init_db()
+    return _CONN
+
+# ===== Worker pool cho ingest =====
+# ProcessPool thay cho BackgroundTasks: ingest nặng CPU (parse + embedding)
+# không chiếm threadpool của Starlette và không bị GIL ghìm server.
+# spawn thay vì fork: worker fork từ process đã khởi tạo OpenMP/torch và đang
+# giữ connection SQLite là công thức deadlock/corruption kinh điển
+_INGEST_EXEC = ProcessPoolExecutor(
+    max_workers=max(2, (os.cpu_count() or 2) // 2),
+    mp_context=multiprocessing.get_context("spawn"),
+)
+_INGEST_FUTURES: dict[int, Future] = {}
+# giữ trạng thái in-process cho các task gần nhất; task cũ hơn đã có bản ghi
+# bền trong bảng uploads nên bỏ theo dõi được
+_MAX_TRACKED_FUTURES = 256
+
+def _parse_preview(path: str, year: int | None):
+    """Parse lazy 300 event đầu cho preview — top-level để picklable cho worker."""
+    it = parse_docx_as_table_iter(path, year)
+    head = list(itertools.islice(it, 300))
+    truncated = next(it, None) is not None
+    return head, truncated
+
+def _events_sidecar(docx_path: Path) -> Path:
+    """File cache events đã parse, nằm cạnh file upload tạm."""
+    return docx_path.with_suffix(".events.json")
+
+def _verify_docx_zip(path: Path) -> None:
+    """Check nhanh file là zip .docx hợp lệ qua mmap (zero-copy, kernel tự
+    page-fault khi cần) — fail sớm trước khi tốn công parse XML."""
+    with open(path, "rb") as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # file rỗng không mmap được
+            raise HTTPException(400, "parse_error: empty file")
+        try:
+            with zipfile.ZipFile(mm) as z:
+                if "word/document.xml" not in z.namelist():
+                    raise HTTPException(400, "parse_error: not a .docx (missing word/document.xml)")
+        except zipfile.BadZipFile:
+            raise HTTPException(400, "parse_error: not a valid zip/.docx")
+        finally:
+            mm.close()
 
 @router.post("/login")
 def login(username: str = Form(...), password: str = Form(...)):
-    if username != ADMIN_USER or password != ADMIN_PASS:
+    if not check_admin_credentials(username, password):
         raise HTTPException(401, "Bad credentials")
     return {"token": make_token(username)}
 
 @router.post("/upload/preview")
-def upload_preview(
+async def upload_preview(
+    request: Request,
     file: UploadFile = File(...),
     year: int | None = Form(None),
     admin: str = Depends(require_admin),
@@ -36,28 +121,56 @@ def upload_preview(
     if not safe_name.lower().endswith(".docx"):
         raise HTTPException(400, "Only .docx is supported")
 
+    # từ chối sớm ngay từ header, chưa tốn byte nào
+    content_length = request.headers.get("content-length")
+    if content_length and int(content_length) > MAX_UPLOAD:
+        raise HTTPException(413, "file too large")
+
     tmp_name = f"upload_{int(dt.datetime.now().timestamp())}_{safe_name}"
     tmp_path = UPLOAD_DIR / tmp_name
-    tmp_path.write_bytes(file.file.read())
+    # stream từng chunk 1 MiB xuống đĩa, không load cả file vào RAM;
+    # vừa stream vừa đếm byte phòng Content-Length nói dối
+    total = 0
+    with tmp_path.open("wb") as f:
+        while chunk := await file.read(1 << 20):
+            total += len(chunk)
+            if total > MAX_UPLOAD:
+                break
+            f.write(chunk)
+    if total > MAX_UPLOAD:
+        tmp_path.unlink(missing_ok=True)
+        raise HTTPException(413, "file too large")
+
+    # verify zip + pre-warm page cache trước khi vào parser
+    _verify_docx_zip(tmp_path)
 
     try:
-        from docx import Document
-        doc = Document(tmp_path.as_posix())
-        default_year = year or infer_year_from_doc(doc) or dt.date.today().year
-        events = parse_docx_as_table(tmp_path.as_posix(), default_year)
+        # parse thuần Python giữ GIL suốt -> đẩy sang worker process để
+        # N upload đồng thời scale theo số core thay vì xếp hàng sau 1 thread
+        loop = asyncio.get_running_loop()
+        events, truncated = await loop.run_in_executor(
+            _INGEST_EXEC, _parse_preview, tmp_path.as_posix(), year
+        )
     except Exception as e:
         raise HTTPException(400, f"parse_error: {e}")
 
+    # cache events đã parse ra sidecar để /ingest khỏi parse lại DOCX
+    # (chỉ khi đã parse trọn vẹn; file bị cắt thì để ingest tự parse đủ)
+    if not truncated:
+        _events_sidecar(tmp_path).write_text(
+            json.dumps(events, ensure_ascii=False), encoding="utf-8"
+        )
+
     return {
         "file": safe_name,
         "temp_path": tmp_path.as_posix(),
         "count": len(events),
-        "events": events[:300],
+        "truncated": truncated,
+        "events": events,
     }
 
 @router.post("/ingest")
 def do_ingest(
-    bg: BackgroundTasks,
     temp_path: str = Form(...),
     mode: str = Form("append"),           # append | rebuild
     tag: str | None = Form(None),
@@ -77,25 +190,49 @@ def do_ingest(
     if mode not in ("append", "rebuild"):
         raise HTTPException(400, detail="mode must be 'append' or 'rebuild'")
 
-    task_id = int(dt.datetime.now().timestamp())
+    # ms-granularity: id ~1.7e12 < 2^53 nên JSON.parse phía admin UI không làm
+    # tròn (ns ~1.8e18 thì có — id echo lại /uploads/{id}/state sẽ trỏ sai
+    # dòng); 2 ingest trong cùng ms thì bump +1, vẫn sort theo thời gian
+    task_id = time.time_ns() // 1_000_000
+    while task_id in _INGEST_FUTURES:
+        task_id += 1
     # log trạng thái queued để UI thấy ngay
     _log_upload(task_id, filename=p.name, tag=tag, mode=mode, status="queued")
-    bg.add_task(_ingest_task, p.as_posix(), mode, tag, dedupe, task_id)
+    fut = _INGEST_EXEC.submit(_ingest_task, p.as_posix(), mode, tag, dedupe, task_id)
+    # dọn future đã xong trước khi thêm — map không phình vô hạn theo số ingest
+    if len(_INGEST_FUTURES) >= _MAX_TRACKED_FUTURES:
+        for tid in [t for t, f in _INGEST_FUTURES.items() if f.done()]:
+            _INGEST_FUTURES.pop(tid, None)
+    _INGEST_FUTURES[task_id] = fut
     return {"task_id": task_id, "status": "queued"}
 
+@router.get("/uploads/{task_id}/state")
+def ingest_state(task_id: int, admin: str = Depends(require_admin)):
+    """Trạng thái in-process của task ingest (không cần query SQLite)."""
+    fut = _INGEST_FUTURES.get(task_id)
+    if fut is None:
+        raise HTTPException(404, detail=f"unknown task_id: {task_id}")
+    if fut.running():
+        state = "running"
+    elif fut.done():
+        state = "failed" if fut.exception() else "done"
+    else:
+        state = "queued"
+    return {"task_id": task_id, "state": state}
+
 def _ingest_task(temp_path: str, mode: str, tag: str | None, dedupe: bool, task_id: int):
     try:
         p = Path(temp_path)
         if not p.exists():
             raise FileNotFoundError(f"temp_path not found: {temp_path!r}")
 
-        from docx import Document
-        import datetime as _dt
-        from backend.rag.parser import parse_docx_as_table, infer_year_from_doc
-
-        doc = Document(p.as_posix())
-        default_year = infer_year_from_doc(doc) or _dt.date.today().year
-        events = parse_docx_as_table(p.as_posix(), default_year)
+        # ưu tiên sidecar từ bước preview (bỏ hẳn lần parse DOCX thứ 2)
+        sidecar = _events_sidecar(p)
+        if sidecar.exists():
+            events = json.loads(sidecar.read_text(encoding="utf-8"))
+        else:
+            # fast-path streaming; year tự suy ra bên trong parse_docx_as_table
+            events = parse_docx_as_table(p.as_posix())
 
         if mode == "rebuild":
             res = rebuild_events(events, STORE_DIR)
@@ -112,6 +249,7 @@ def _ingest_task(temp_path: str, mode: str, tag: str | None, dedupe: bool, task_
             status="done",
             log=json.dumps(res, ensure_ascii=False),
         )
+        sidecar.unlink(missing_ok=True)  # ingest xong thì dọn cache
     except Exception:
         import traceback
         err = traceback.format_exc()
@@ -120,80 +258,87 @@ def _ingest_task(temp_path: str, mode: str, tag: str | None, dedupe: bool, task_
 
 def _log_upload(task_id: int, filename: str | None=None, tag: str | None=None, mode: str | None=None,
                 status: str="queued", added: int | None=None, total: int | None=None, log: str | None=None):
-    Path(STORE_DIR).mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""CREATE TABLE IF NOT EXISTS uploads(
-      id INTEGER PRIMARY KEY,
-      filename TEXT, tag TEXT, mode TEXT, total_events INTEGER, added_events INTEGER,
-      status TEXT, log TEXT, created_at TEXT, updated_at TEXT)""")
     now = dt.datetime.now().isoformat(timespec="seconds")
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM uploads WHERE id=?", (task_id,))
-    if cur.fetchone():
-        cur.execute("""UPDATE uploads SET status=?, added_events=COALESCE(?,added_events),
-                       total_events=COALESCE(?,total_events), log=COALESCE(?,log), updated_at=? WHERE id=?""",
-                    (status, added, total, log, now, task_id))
-    else:
-        cur.execute("""INSERT INTO uploads(id,filename,tag,mode,total_events,added_events,status,log,created_at,updated_at)
-                       VALUES(?,?,?,?,?,?,?,?,?,?)""",
-                    (task_id, filename, tag, mode, total, added, status, log, now, now))
-    conn.commit(); conn.close()
-
-@router.get("/uploads")
-def list_uploads(admin: str = Depends(require_admin)):
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM uploads ORDER BY id DESC LIMIT 50")
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return {"items": rows}
+    with _DB_LOCK:
+        conn = _db()
+        # 1 câu UPSERT duy nhất thay cho SELECT + branch INSERT/UPDATE
+        conn.execute("""INSERT INTO uploads(id,filename,tag,mode,total_events,added_events,status,log,created_at,updated_at)
+                         VALUES(?,?,?,?,?,?,?,?,?,?)
+                         ON CONFLICT(id) DO UPDATE SET
+                           status=excluded.status,
+                           added_events=COALESCE(excluded.added_events, uploads.added_events),
+                           total_events=COALESCE(excluded.total_events, uploads.total_events),
+                           log=COALESCE(excluded.log, uploads.log),
+                           updated_at=excluded.updated_at""",
+                     (task_id, filename, tag, mode, total, added, status, log, now, now))
+        conn.commit()
 
 # Phân trang
-
-from fastapi import Query
-
 @router.get("/uploads")
 def list_uploads(
     admin: str = Depends(require_admin),
     page: int = Query(1, ge=1),
     page_size: int = Query(8, ge=1, le=200),         # mặc định 8
     tag: str | None = Query(None),
+    before_id: int | None = Query(None),             # keyset pagination (nhanh với trang sâu)
 ):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    with _DB_LOCK:
+        cur = _db().cursor()
 
-    # total
-    if tag:
-        cur.execute("SELECT COUNT(*) FROM uploads WHERE COALESCE(tag,'') = ?", (tag,))
-    else:
-        cur.execute("SELECT COUNT(*) FROM uploads")
-    total = cur.fetchone()[0]
-
-    # normalize
-    total_pages = max((total + page_size - 1) // page_size, 1)
-    if page > total_pages:
-        page = total_pages
-    offset = (page - 1) * page_size
-
-    # fetch page
-    if tag:
-        cur.execute(
-            """SELECT * FROM uploads
-               WHERE COALESCE(tag,'') = ?
-               ORDER BY id DESC
-               LIMIT ? OFFSET ?""",
-            (tag, page_size, offset),
-        )
-    else:
-        cur.execute(
-            """SELECT * FROM uploads
-               ORDER BY id DESC
-               LIMIT ? OFFSET ?""",
-            (page_size, offset),
-        )
-    items = [dict(r) for r in cur.fetchall()]
-    conn.close()
+        # keyset: WHERE id < before_id -> O(page_size) bất kể bảng to cỡ nào
+        if before_id is not None:
+            if tag:
+                cur.execute(
+                    """SELECT * FROM uploads
+                       WHERE id < ? AND COALESCE(tag,'') = ?
+                       ORDER BY id DESC LIMIT ?""",
+                    (before_id, tag, page_size),
+                )
+            else:
+                cur.execute(
+                    "SELECT * FROM uploads WHERE id < ? ORDER BY id DESC LIMIT ?",
+                    (before_id, page_size),
+                )
+            cols = [c[0] for c in cur.description]
+            items = [dict(zip(cols, r)) for r in cur.fetchall()]
+            return {
+                "items": items,
+                "page_size": page_size,
+                "next_before_id": items[-1]["id"] if items else None,
+                "has_next": len(items) == page_size,
+            }
+
+        # total
+        if tag:
+            cur.execute("SELECT COUNT(*) FROM uploads WHERE COALESCE(tag,'') = ?", (tag,))
+        else:
+            cur.execute("SELECT COUNT(*) FROM uploads")
+        total = cur.fetchone()[0]
+
+        # normalize
+        total_pages = max((total + page_size - 1) // page_size, 1)
+        if page > total_pages:
+            page = total_pages
+        offset = (page - 1) * page_size
+
+        # fetch page
+        if tag:
+            cur.execute(
+                """SELECT * FROM uploads
+                   WHERE COALESCE(tag,'') = ?
+                   ORDER BY id DESC
+                   LIMIT ? OFFSET ?""",
+                (tag, page_size, offset),
+            )
+        else:
+            cur.execute(
+                """SELECT * FROM uploads
+                   ORDER BY id DESC
+                   LIMIT ? OFFSET ?""",
+                (page_size, offset),
+            )
+        cols = [c[0] for c in cur.description]
+        items = [dict(zip(cols, r)) for r in cur.fetchall()]
 
     return {
         "items": items,
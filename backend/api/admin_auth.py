@@ -1,5 +1,6 @@
 # backend/api/admin_auth.py
-import os, time, hmac, base64
+import os, time, hmac, base64, hashlib, threading
+from collections import OrderedDict
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
@@ -19,6 +20,19 @@ if len(SECRET_BYTES) < 16:
     # raise RuntimeError("ADMIN_SECRET too weak (<16 bytes)")
     pass
 
+# Hash ADMIN_PASS 1 lần lúc import (salt ngẫu nhiên theo process) — login chỉ
+# so sánh digest, không giữ plaintext trên đường so sánh và không lộ timing
+_PW_SALT  = os.urandom(16)
+_PW_ITERS = 100_000
+_ADMIN_PASS_HASH = hashlib.pbkdf2_hmac("sha256", ADMIN_PASS.encode("utf-8"), _PW_SALT, _PW_ITERS)
+
+def check_admin_credentials(username: str, password: str) -> bool:
+    """So sánh constant-time cho cả username lẫn password (chặn timing oracle)."""
+    u_ok = hmac.compare_digest(username.encode("utf-8"), ADMIN_USER.encode("utf-8"))
+    p_hash = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), _PW_SALT, _PW_ITERS)
+    p_ok = hmac.compare_digest(p_hash, _ADMIN_PASS_HASH)
+    return u_ok and p_ok
+
 # Nếu muốn nới lỏng cho swagger thử nghiệm thì auto_error=False
 security = HTTPBearer(auto_error=True)
 
@@ -30,9 +44,19 @@ def _b64url_decode(s: str) -> bytes:
     pad = "=" * ((4 - (len(s) % 4)) % 4)
     return base64.urlsafe_b64decode((s + pad).encode())
 
+# sha256 nên đi qua backend OpenSSL để tận dụng SHA-NI / ARMv8 crypto ext;
+# nếu interpreter build thiếu _hashlib thì chỉ cảnh báo (vẫn chạy bản C thuần)
+if not hasattr(hashlib, "openssl_sha256"):
+    print("[ADMIN_AUTH] hashlib is not OpenSSL-backed; HMAC-SHA256 will use the slower portable implementation")
+
+# HMAC prototype: derive key state 1 lần, mỗi lần ký chỉ copy() + update()
+# (digestmod là string để hmac đi theo fast-path C / _hashlib.hmac)
+_HMAC_PROTO = hmac.new(SECRET_BYTES, b"", digestmod="sha256")
+
 def _sign(payload: bytes) -> str:
-    dig = hmac.new(SECRET_BYTES, payload, digestmod="sha256").digest()
-    return _b64url(dig)
+    h = _HMAC_PROTO.copy()
+    h.update(payload)
+    return _b64url(h.digest())
 
 def make_token(user: str, exp_sec: int = 3600) -> str:
     # token = base64url(payload) + "." + base64url(signature)
@@ -45,9 +69,25 @@ def make_token(user: str, exp_sec: int = 3600) -> str:
     sig = _sign(payload)
     return f"{_b64url(payload)}.{sig}"
 
+# Cache token đã verify: token -> (user, exp). Chỉ chứa token ĐÃ qua HMAC nên
+# không giảm an toàn; hot path thành 1 dict lookup thay vì base64 + HMAC.
+_TOKEN_CACHE: OrderedDict[str, tuple[str, int]] = OrderedDict()
+_TOKEN_CACHE_MAX = 4096
+_TOKEN_CACHE_LOCK = threading.Lock()
+
 def verify_token(token: str) -> str:
+    token = token.strip()
+    now = int(time.time())
+    with _TOKEN_CACHE_LOCK:
+        hit = _TOKEN_CACHE.get(token)
+        if hit:
+            if hit[1] >= now:
+                _TOKEN_CACHE.move_to_end(token)  # LRU
+                return hit[0]
+            del _TOKEN_CACHE[token]  # hết hạn thì bỏ luôn
+
     try:
-        payload_b64, sig_given = token.strip().split(".", 1)
+        payload_b64, sig_given = token.split(".", 1)
         payload = _b64url_decode(payload_b64)
         sig_calc = _sign(payload)
         # so sánh constant-time
@@ -55,8 +95,15 @@ def verify_token(token: str) -> str:
             raise ValueError("bad-sign")
 
         user, exp_str = payload.decode("utf-8").split("|", 1)
-        if int(exp_str) < int(time.time()):
+        exp = int(exp_str)
+        if exp < now:
             raise ValueError("expired")
+
+        with _TOKEN_CACHE_LOCK:
+            _TOKEN_CACHE[token] = (user, exp)
+            _TOKEN_CACHE.move_to_end(token)
+            while len(_TOKEN_CACHE) > _TOKEN_CACHE_MAX:
+                _TOKEN_CACHE.popitem(last=False)
         return user
     except Exception:
         # để tránh lộ lý do cụ thể -> trả 401 chung
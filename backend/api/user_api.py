@@ -2,6 +2,7 @@
 from __future__ import annotations
 import traceback
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import os
 
@@ -24,7 +25,22 @@ def _lazy_import_rag():
         rag_import_error = f"{e}\n{traceback.format_exc()}"
 
 # ========== Router ==========
-router = APIRouter(prefix="/api", tags=["chat"])
+# orjson serialize nhanh hơn json chuẩn ~4-5x cho payload chat
+router = APIRouter(prefix="/api", tags=["chat"], default_response_class=ORJSONResponse)
+
+@router.on_event("startup")
+def _warm_rag():
+    """Nạp RAG (FAISS index + encoder) lúc khởi động thay vì ở request đầu.
+    Store chưa build thì vẫn không crash — giữ nguyên cơ chế lazy làm fallback,
+    request sau sẽ thử import lại khi store đã có."""
+    _lazy_import_rag()
+    if rag_import_error:
+        return
+    try:
+        from backend.rag.io_store import _st_model
+        _st_model()  # kéo weights của encoder vào RAM ngay từ boot
+    except Exception:
+        pass
 
 # Request/Response Model
 class ChatRequest(BaseModel):
@@ -51,7 +67,8 @@ def api_chat(req: ChatRequest):
         answer = (res.get("answer") or "").strip()
         if not answer:
             answer = "Mình không tìm thấy thông tin trong lịch tuần này."
-        return ChatResponse(answer=answer)
+        # trả Response trực tiếp: khỏi tốn validate lại model cho payload 1 field
+        return ORJSONResponse({"answer": answer})
     except Exception as e:
         raise HTTPException(500, detail=f"internal_error: {e}")
 
@@ -65,6 +82,6 @@ def api_ask_compat(req: AskIn):
     if rag_import_error:
         raise HTTPException(500, detail=f"RAG init failed: {rag_import_error}")
     try:
-        return rag_ask(RAGAsk(question=req.question))
+        return ORJSONResponse(rag_ask(RAGAsk(question=req.question)))
     except Exception as e:
         raise HTTPException(500, detail=f"internal_error: {e}")
\ No newline at end of file
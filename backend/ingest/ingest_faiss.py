@@ -1,25 +1,99 @@
-import argparse, os, json, sqlite3, hashlib
-import numpy as np, faiss
+import argparse, mmap, os, sqlite3, hashlib
+
+# phải set TRƯỚC khi import faiss: OpenMP đọc env lúc khởi tạo runtime;
+# PASSIVE để worker nhả CPU khi chờ thay vì spin
+os.environ.setdefault("OMP_WAIT_POLICY", "PASSIVE")
+
+import numpy as np, faiss, orjson
 from sentence_transformers import SentenceTransformer
 
+# FAISS add/search không scale tốt quá ~8 thread với dữ liệu cỡ này
+faiss.omp_set_num_threads(min(8, os.cpu_count() or 1))
+
+# encode theo slab cố định: peak RAM là O(EMB_FLUSH), không phải O(N sự kiện)
+EMB_FLUSH = 1024
+
+def iter_jsonl(path):
+    """Stream từng event từ JSONL qua mmap: page cache của kernel phục vụ
+    thẳng, không copy qua buffer Python; file rỗng thì mmap lỗi -> không event."""
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # file 0 byte
+            return
+        try:
+            for line in iter(mm.readline, b""):
+                if line.strip():
+                    yield orjson.loads(line)
+        finally:
+            mm.close()
+
+def existing_in_db(cur, hashes):
+    """Tập hash đã có trong chunks: đổ ứng viên vào temp table rồi join với
+    index UNIQUE — 1 câu SQL chạy trong C thay vì IN theo nhóm 900."""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS _pending(hash BLOB PRIMARY KEY)")
+    cur.execute("DELETE FROM _pending")
+    cur.executemany("INSERT OR IGNORE INTO _pending VALUES(?)",
+                    ((h,) for h in hashes))
+    found = {h for (h,) in cur.execute(
+        "SELECT p.hash FROM _pending p JOIN chunks c ON c.hash = p.hash")}
+    cur.execute("DELETE FROM _pending")
+    return found
+
+def encode_sorted(model, texts):
+    """Smart batching: sort theo độ dài để batch ít padding, trả về thứ tự gốc."""
+    order = np.argsort([len(t) for t in texts])
+    embs = model.encode(
+        [texts[i] for i in order],
+        batch_size=int(os.getenv("EMB_BATCH_SIZE", "64")),
+        convert_to_numpy=True,
+        convert_to_tensor=False,
+        show_progress_bar=False,
+    )
+    # scatter thẳng vào buffer float32 C-contiguous: trả về thứ tự gốc + ép
+    # dtype trong CÙNG một lượt ghi, không qua copy trung gian
+    embs = np.asarray(embs)
+    out = np.empty((len(texts), embs.shape[1]), dtype=np.float32)
+    out[order] = embs
+    assert out.flags["C_CONTIGUOUS"] and out.dtype == np.float32
+    # chuẩn hoá L2 bằng SIMD của FAISS trên cả khối, thay normalize_embeddings=True
+    faiss.normalize_L2(out)
+    return out
+
 def chunk_text_fields(ev):
+    # unroll thẳng 8 trường (không loop + lookup tên trường): hàm chạy
+    # 1 lần/event, interpreter overhead cộng dồn đáng kể với JSONL lớn
+    d = ev.get
     fields = []
-    for k in ("date","dow","start","end","location","participants","title"):
-        if ev.get(k):
-            fields.append(f"{k}: {ev[k]}")
-    if ev.get("raw"):
-        fields.append(f"raw: {ev['raw']}")
+    v = d("date")
+    if v: fields.append(f"date: {v}")
+    v = d("dow")
+    if v: fields.append(f"dow: {v}")
+    v = d("start")
+    if v: fields.append(f"start: {v}")
+    v = d("end")
+    if v: fields.append(f"end: {v}")
+    v = d("location")
+    if v: fields.append(f"location: {v}")
+    v = d("participants")
+    if v: fields.append(f"participants: {v}")
+    v = d("title")
+    if v: fields.append(f"title: {v}")
+    v = d("raw")
+    if v: fields.append(f"raw: {v}")
     return "\n".join(fields)
 
-def sha1(s: str) -> str:
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+def sha1(s: str) -> bytes:
+    # digest thô 20 byte thay vì hex 40 ký tự: index hash nhỏ đi một nửa
+    # usedforsecurity=False: content-address thuần, bỏ wrapper FIPS
+    return hashlib.sha1(s.encode("utf-8"), usedforsecurity=False).digest()
 
 def ensure_schema(conn: sqlite3.Connection):
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chunks(
         id INTEGER PRIMARY KEY,
-        hash TEXT UNIQUE,
+        hash BLOB UNIQUE,
         text TEXT,
         date TEXT, dow TEXT, start TEXT, end TEXT,
         location TEXT, participants TEXT, title TEXT, raw TEXT
@@ -38,9 +112,9 @@ def get_meta(conn: sqlite3.Connection, key: str) -> str | None:
     return row[0] if row else None
 
 def set_meta(conn: sqlite3.Connection, key: str, val: str):
+    # không commit ở đây — caller gom các set_meta vào chung 1 transaction
     cur = conn.cursor()
     cur.execute("INSERT INTO meta(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v", (key,val))
-    conn.commit()
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
@@ -55,17 +129,13 @@ if __name__ == "__main__":
     sqlite_path = os.path.join(args.store_dir, "chunks.sqlite")
     faiss_path  = os.path.join(args.store_dir, "index.faiss")
 
-    # ----- Load events -----
-    events = []
-    with open(args.jsonl, "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():
-                events.append(json.loads(line))
-    if not events:
-        raise SystemExit("No events found in JSONL. Check parse step.")
-
     # ----- Open SQLite & ensure schema -----
+    # WAL + pragmas cho bulk insert: fsync theo batch, page cache 64MB
     conn = sqlite3.connect(sqlite_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
     ensure_schema(conn)
     cur = conn.cursor()
 
@@ -77,13 +147,16 @@ if __name__ == "__main__":
         index = faiss.read_index(faiss_path)
         n_old = index.ntotal
 
-        # kiểm tra tương thích model + dim
+        # kiểm tra tương thích model + dim + loại index
         prev_model = get_meta(conn, "emb_model")
         prev_dim   = get_meta(conn, "emb_dim")
+        prev_type  = get_meta(conn, "index_type")
         if prev_model and prev_model != args.local_emb:
             raise SystemExit(f"[ERR] Embedding model mismatch: store='{prev_model}', given='{args.local_emb}'. Run without --append to rebuild.")
         if prev_dim and int(prev_dim) != dim:
             raise SystemExit(f"[ERR] Embedding dim mismatch: store={prev_dim}, model={dim}. Run without --append to rebuild.")
+        if prev_type != "hnsw":
+            raise SystemExit("[ERR] Store uses the old flat index; cannot append onto it. Run without --append to rebuild as HNSW.")
 
         # sanity check số bản ghi trong SQLite khớp ntotal
         cur.execute("SELECT COUNT(*) FROM chunks")
@@ -92,8 +165,10 @@ if __name__ == "__main__":
             raise SystemExit(f"[ERR] Inconsistent state: FAISS ntotal={n_old} but SQLite rows={rows_cnt}. "
                              f"Please rebuild (run without --append) to resync.")
     else:
-        # build mới
-        index = faiss.IndexFlatIP(dim)
+        # build mới: HNSW search ~log(N) thay vì quét tuyến tính; IDMap2 giữ id ổn định
+        hnsw = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = 200
+        index = faiss.IndexIDMap2(hnsw)
         n_old = 0
         # clear SQLite nếu không append
         cur.execute("DELETE FROM chunks")
@@ -102,68 +177,69 @@ if __name__ == "__main__":
     # lưu meta (sau khi đã pass các checks)
     set_meta(conn, "emb_model", args.local_emb)
     set_meta(conn, "emb_dim", str(dim))
+    set_meta(conn, "index_type", "hnsw")
+    conn.commit()
 
     # ----- Dedupe -----
-    # 1) Dedupe so với DB (trừ khi --no-dedupe)
-    existing_hashes = set()
-    if not args.no_dedupe:
-        for (h,) in cur.execute("SELECT hash FROM chunks"):
-            existing_hashes.add(h)
-
-    # 2) Dedupe trong batch (tránh lặp trong file JSONL)
+    # so với DB: kiểm tra theo slab lúc flush (WHERE hash IN (...)),
+    # trong file: set batch_seen tránh lặp trong chính JSONL
     batch_seen = set()
 
-    new_records = []  # (hash, text, ev)
-    for ev in events:
+    # ----- Stream events -> encode theo slab -> add FAISS + insert SQLite -----
+    # không giữ cả file JSONL lẫn list new_records trong RAM; mỗi slab
+    # EMB_FLUSH record được encode, add và insert xong là thả luôn
+    def flush_slab(slab, next_id):
+        if not args.no_dedupe:
+            dup = existing_in_db(cur, [r[0] for r in slab])
+            slab = [r for r in slab if r[0] not in dup]
+            if not slab:
+                return next_id
+        embs = encode_sorted(model, [r[1] for r in slab])
+        before = index.ntotal
+        index.add_with_ids(embs, np.arange(next_id, next_id + len(slab), dtype="int64"))
+        if index.ntotal - before != len(slab):
+            raise SystemExit(f"[ERR] FAISS add mismatch: expected +{len(slab)} but got +{index.ntotal - before}.")
+        cur.executemany("""INSERT INTO chunks(
+            id, hash, text, date, dow, start, end, location, participants, title, raw
+        ) VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+        [(next_id + i, h, txt,
+          ev.get("date"), ev.get("dow"), ev.get("start"), ev.get("end"),
+          ev.get("location"), ev.get("participants"), ev.get("title"), ev.get("raw"))
+         for i, (h, txt, ev) in enumerate(slab)])
+        conn.commit()
+        return next_id + len(slab)
+
+    total_read = 0
+    next_id = n_old
+    slab = []  # (hash, text, ev)
+    for ev in iter_jsonl(args.jsonl):
+        total_read += 1
         txt = chunk_text_fields(ev)
         h = sha1(txt)
-        if args.no_dedupe:
-            if h in batch_seen:
-                continue
-            batch_seen.add(h)
-            new_records.append((h, txt, ev))
-        else:
-            if h in existing_hashes or h in batch_seen:
-                continue
-            batch_seen.add(h)
-            new_records.append((h, txt, ev))
-
-    if not new_records:
+        if h in batch_seen:
+            continue
+        batch_seen.add(h)
+        slab.append((h, txt, ev))
+        if len(slab) >= EMB_FLUSH:
+            next_id = flush_slab(slab, next_id)
+            slab = []
+    if slab:
+        next_id = flush_slab(slab, next_id)
+
+    if total_read == 0:
+        raise SystemExit("No events found in JSONL. Check parse step.")
+
+    added = next_id - n_old
+    if added == 0:
         print("[OK] Nothing new to ingest (all duplicates).")
         print("[OK] FAISS:", faiss_path)
         print("[OK] SQLite:", sqlite_path)
         conn.close()
         raise SystemExit(0)
 
-    texts = [r[1] for r in new_records]
-    embs = model.encode(texts, normalize_embeddings=True)
-    embs = np.asarray(embs, dtype="float32")
-
-    # ----- Append vectors -----
-    before = index.ntotal
-    index.add(embs)
-    after = index.ntotal
-    if after - before != len(new_records):
-        raise SystemExit(f"[ERR] FAISS add mismatch: expected +{len(new_records)} but got +{after-before}.")
-
-    faiss.write_index(index, faiss_path)
-
-    # ----- Insert metadata rows with stable IDs (offset by n_old) -----
-    # id phải chạy liên tục từ 0..index.ntotal-1
-    start_id = n_old
-    rows = []
-    for i, (h, txt, ev) in enumerate(new_records):
-        rid = start_id + i
-        rows.append((
-            rid, h, txt,
-            ev.get("date"), ev.get("dow"), ev.get("start"), ev.get("end"),
-            ev.get("location"), ev.get("participants"), ev.get("title"), ev.get("raw")
-        ))
-
-    cur.executemany("""INSERT INTO chunks(
-        id, hash, text, date, dow, start, end, location, participants, title, raw
-    ) VALUES (?,?,?,?,?,?,?,?,?,?,?)""", rows)
-    conn.commit()
+    # ghi ra .tmp rồi os.replace: crash giữa chừng không để lại index cụt
+    faiss.write_index(index, faiss_path + ".tmp")
+    os.replace(faiss_path + ".tmp", faiss_path)
 
     # verify: số hàng trong SQLite phải == index.ntotal
     cur.execute("SELECT COUNT(*) FROM chunks")
@@ -174,6 +250,6 @@ if __name__ == "__main__":
 
     conn.close()
 
-    print(f"[OK] Stored {len(new_records)} new chunks (total was {n_old}, now {n_old + len(new_records)})")
+    print(f"[OK] Stored {added} new chunks (total was {n_old}, now {n_old + added})")
     print("[OK] FAISS:", faiss_path)
     print("[OK] SQLite:", sqlite_path)
\ No newline at end of file
@@ -2,75 +2,151 @@
 from __future__ import annotations
 
 import os
+
+# phải set TRƯỚC khi import faiss: OpenMP đọc env lúc khởi tạo runtime.
+# PASSIVE để worker nhả CPU khi chờ thay vì spin — ingest chạy chung host
+# với web app nên không được chiếm core khi idle.
+os.environ.setdefault("OMP_WAIT_POLICY", "PASSIVE")
+
+import functools
 import hashlib
 import sqlite3
 from typing import List, Dict, Tuple
 
 import numpy as np
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
 
+# dùng hết core cho forward pass của transformer khi encode trên CPU
+torch.set_num_threads(os.cpu_count() or 1)
+# FAISS add/search không scale tốt quá ~8 thread với dữ liệu cỡ này
+faiss.omp_set_num_threads(min(8, os.cpu_count() or 1))
+
+# batch_size cho encode — chỉnh theo host qua env; mặc định 64 trên GPU,
+# 32 trên CPU (batch to hơn trên CPU chỉ tăng padding, không tăng throughput)
+EMB_BATCH_SIZE = int(os.getenv(
+    "EMB_BATCH_SIZE", "64" if torch.cuda.is_available() else "32"))
+
+
+@functools.lru_cache(maxsize=4)
+def _get_model(name: str, device: str | None = None):
+    """Cache model theo (tên, device): mỗi lần append không phải load lại
+    weights từ đĩa. eval() tắt dropout/autograd bookkeeping; trên GPU hạ
+    xuống FP16 (forward pass nhanh ~2x, embeddings gần như y hệt).
+    EMB_BACKEND=onnx chuyển sang encoder ONNX Runtime int8 (tuỳ chọn,
+    cần optimum[onnxruntime]) — nhanh hơn hẳn trên CPU x86 có VNNI."""
+    if os.getenv("EMB_BACKEND") == "onnx":
+        from backend.rag.embed_onnx import OnnxEncoder
+        model = OnnxEncoder(name)
+    else:
+        model = SentenceTransformer(name, device=device)
+        model.eval()
+        if torch.cuda.is_available():
+            model.half()
+    # nhớ tên model trên instance: nơi khác đối chiếu với meta emb_model
+    model._emb_name = name
+    return model
+
+
+def _encode_texts(model, texts: List[str]) -> np.ndarray:
+    """Smart batching: sort theo độ dài trước khi encode để batch ít padding
+    (texts sự kiện dài ngắn rất lệch nhau), rồi trả embeddings về thứ tự gốc."""
+    order = np.argsort([len(t) for t in texts])
+    embs = model.encode(
+        [texts[i] for i in order],
+        batch_size=EMB_BATCH_SIZE,
+        convert_to_numpy=True,
+        convert_to_tensor=False,
+        show_progress_bar=False,
+    )
+    # scatter thẳng vào buffer float32 C-contiguous: trả về thứ tự gốc + ép
+    # dtype trong CÙNG một lượt ghi, không qua copy trung gian (fancy index
+    # rồi ascontiguousarray là 2 lần memcpy khi encode trả fp16/tensor view)
+    embs = np.asarray(embs)
+    out = np.empty((len(texts), embs.shape[1]), dtype=np.float32)
+    out[order] = embs
+    assert out.flags["C_CONTIGUOUS"] and out.dtype == np.float32
+    # chuẩn hoá L2 bằng SIMD của FAISS trên cả khối, thay normalize_embeddings=True
+    faiss.normalize_L2(out)
+    return out
+
+# meta gate: store cũ kiểu flat (hoặc đổi FAISS_QUANT) sẽ được rebuild lại
+# FAISS_QUANT=fp16 -> HNSW trên scalar quantizer fp16: nửa RAM/bandwidth,
+# recall với MiniLM gần như không đổi
+INDEX_TYPE = "hnsw-sq16" if os.getenv("FAISS_QUANT") == "fp16" else "hnsw"
+
+def _write_index_atomic(index: faiss.Index, faiss_path: str) -> None:
+    """Ghi index ra file .tmp rồi os.replace — crash giữa chừng không để lại
+    index cụt; reader (io_store) luôn thấy file cũ hoặc file mới nguyên vẹn."""
+    tmp = faiss_path + ".tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, faiss_path)
+
+def _new_index(dim: int) -> faiss.Index:
+    """HNSW (M=32, efConstruction=200) thay cho IndexFlatIP: search ~log(N)
+    thay vì quét tuyến tính. Bọc IndexIDMap2 để id khớp rowid SQLite ổn định
+    qua các lần append. FAISS_QUANT=fp16 lưu vector dạng fp16 (HNSW+SQ)."""
+    if INDEX_TYPE == "hnsw-sq16":
+        hnsw = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, 32,
+                                 faiss.METRIC_INNER_PRODUCT)
+    else:
+        hnsw = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    hnsw.hnsw.efConstruction = 200
+    return faiss.IndexIDMap2(hnsw)
+
 # thêm ở đầu file (tiện ích nhỏ)
 def _backfill_hashes(conn: sqlite3.Connection):
-    """Điền hash cho các dòng cũ chưa có hash để dedupe chuẩn."""
+    """Điền hash cho các dòng cũ chưa có hash để dedupe chuẩn.
+
+    Store đời trước lưu hash dạng hex TEXT 40 ký tự; digest BLOB không bao giờ
+    bằng chuỗi hex trong join của _existing_hashes nên phải re-hash luôn các
+    dòng typeof='text' (bao gồm cả chuỗi rỗng), không chỉ dòng NULL."""
     cur = conn.cursor()
-    cur.execute("SELECT id, text FROM chunks WHERE hash IS NULL OR TRIM(hash)=''")
+    cur.execute("SELECT id, text FROM chunks WHERE hash IS NULL OR typeof(hash)!='blob'")
     rows = cur.fetchall()
     if not rows:
         return 0
-    for rid, txt in rows:
-        h = _sha1(txt or "")
-        cur.execute("UPDATE chunks SET hash=? WHERE id=?", (h, rid))
+    cur.executemany("UPDATE chunks SET hash=? WHERE id=?",
+                    [(_sha1(txt or ""), rid) for rid, txt in rows])
     conn.commit()
     return len(rows)
 
 def _rebuild_faiss_from_sqlite(conn: sqlite3.Connection, faiss_path: str,
-                               model: SentenceTransformer) -> int:
+                               model) -> int:
     """Khi lệch rows vs ntotal, build lại FAISS theo SQLite để đồng bộ."""
     cur = conn.cursor()
-    cur.execute("SELECT id, text FROM chunks ORDER BY id ASC")
+    dim = model.get_sentence_embedding_dimension()
+    cur.execute("SELECT id, text, emb FROM chunks ORDER BY id ASC")
     rows = cur.fetchall()
     if not rows:
-        index = faiss.IndexFlatIP(model.get_sentence_embedding_dimension())
-        faiss.write_index(index, faiss_path)
+        index = _new_index(dim)
+        _write_index_atomic(index, faiss_path)
         return 0
-    ids, texts = zip(*rows)
-    # đảm bảo id = 0..n-1 liên tục; nếu không, reindex
-    need_reindex = any(i != idx for idx, i in enumerate(ids))
-    if need_reindex:
-        # tạo bảng tạm và ghi lại id liên tục
-        cur.execute("BEGIN")
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS chunks_new(
-              id INTEGER PRIMARY KEY,
-              text TEXT,
-              date TEXT, dow TEXT, start TEXT, end TEXT,
-              location TEXT, participants TEXT, title TEXT, raw TEXT,
-              hash TEXT
-            )
-        """)
-        cur.execute("INSERT INTO chunks_new(id,text,date,dow,start,end,location,participants,title,raw,hash) "
-                    "SELECT ROW_NUMBER() OVER (ORDER BY id)-1, text,date,dow,start,end,location,participants,title,raw,hash FROM chunks")
-        # SQLite không có WINDOW ROW_NUMBER() cũ; fallback thủ công:
-        cur.execute("DELETE FROM chunks_new")  # xoá nếu dòng trên không chạy trên SQLite cũ
-        cur.execute("SELECT text,date,dow,start,end,location,participants,title,raw,hash FROM chunks ORDER BY id")
-        data = cur.fetchall()
-        cur.execute("DELETE FROM chunks")
-        for i, row in enumerate(data):
-            cur.execute("""INSERT OR REPLACE INTO chunks(
-                id,text,date,dow,start,end,location,participants,title,raw,hash
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?)""", (i,)+row)
+    ids, texts, blobs = zip(*rows)
+
+    # blob emb chỉ tin được nếu store ghi bằng đúng model đang dùng;
+    # khi hợp lệ thì rebuild = memcpy thay vì chạy lại transformer
+    reuse = _get_meta(conn, "emb_model") == getattr(model, "_emb_name", None)
+    embs = np.empty((len(rows), dim), dtype=np.float32)
+    missing = []
+    for i, b in enumerate(blobs):
+        if reuse and b is not None and len(b) == dim * 4:
+            embs[i] = np.frombuffer(b, dtype=np.float32)
+        else:
+            missing.append(i)
+    if missing:
+        embs[missing] = _encode_texts(model, [texts[i] for i in missing])
+
+    # IDMap2 nhận id tuỳ ý: add thẳng id SQLite, khỏi ép id về 0..n-1
+    index = _new_index(dim)
+    index.add_with_ids(np.ascontiguousarray(embs), np.asarray(ids, dtype=np.int64))
+    _write_index_atomic(index, faiss_path)
+    # refresh cache cho những dòng vừa phải encode lại
+    if missing:
+        cur.executemany("UPDATE chunks SET emb=? WHERE id=?",
+                        [(embs[i].tobytes(), ids[i]) for i in missing])
         conn.commit()
-        # load lại texts sau reindex
-        cur.execute("SELECT id, text FROM chunks ORDER BY id ASC")
-        rows = cur.fetchall()
-        ids, texts = zip(*rows)
-
-    embs = model.encode(list(texts), normalize_embeddings=True)
-    embs = np.asarray(embs, dtype="float32")
-    index = faiss.IndexFlatIP(embs.shape[1])
-    index.add(embs)
-    faiss.write_index(index, faiss_path)
     return index.ntotal
 
 # ====== ĐƯỜNG DẪN / SCHEMA ====================================================
@@ -82,9 +158,30 @@ def _paths(store_dir: str) -> Tuple[str, str]:
     return sqlite_path, faiss_path
 
 
+def _connect(sqlite_path: str) -> sqlite3.Connection:
+    """Mở SQLite với WAL + pragmas cho bulk insert (fsync theo batch, không theo dòng)."""
+    conn = sqlite3.connect(sqlite_path)
+    # 'with conn:' sẽ BEGIN IMMEDIATE: lấy write-lock ngay từ đầu transaction,
+    # không bị deadlock nâng cấp lock giữa chừng khi web app đang đọc store
+    conn.isolation_level = "IMMEDIATE"
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64MB page cache
+    return conn
+
+
+# bump khi đổi schema; v2 = chunks có cột hash + emb + index unique trên hash
+_SCHEMA_VERSION = 2
+
+
 def _ensure_schema(conn: sqlite3.Connection) -> None:
     """Tạo bảng nếu thiếu và thêm cột hash nếu DB cũ vẫn chưa có (migrate nhẹ)."""
     cur = conn.cursor()
+    # DB đã đúng phiên bản: khỏi probe table_info + chạy lại ALTER/CREATE INDEX
+    # idempotent mỗi lần mở store
+    if cur.execute("PRAGMA user_version").fetchone()[0] == _SCHEMA_VERSION:
+        return
     # bảng metadata khoá/giá trị
     cur.execute("""
     CREATE TABLE IF NOT EXISTS meta(
@@ -107,13 +204,19 @@ def _ensure_schema(conn: sqlite3.Connection) -> None:
     cur.execute("PRAGMA table_info(chunks)")
     cols = {r[1] for r in cur.fetchall()}
     if "hash" not in cols:
-        cur.execute("ALTER TABLE chunks ADD COLUMN hash TEXT")
+        cur.execute("ALTER TABLE chunks ADD COLUMN hash BLOB")
         # có thể điền dần hash về sau; UNIQUE sẽ tạo trên cột hash để dedupe nhanh
+    # cache embedding float32 theo dòng: rebuild chỉ encode hash mới
+    if "emb" not in cols:
+        cur.execute("ALTER TABLE chunks ADD COLUMN emb BLOB")
+    # dọn bảng mồ côi do code reindex cũ để lại (đã bỏ đường reindex)
+    cur.execute("DROP TABLE IF EXISTS chunks_new")
     # đảm bảo chỉ mục unique cho hash (nếu chưa có)
     cur.execute("""
     CREATE UNIQUE INDEX IF NOT EXISTS idx_chunks_hash_unique
       ON chunks(hash);
     """)
+    cur.execute(f"PRAGMA user_version={_SCHEMA_VERSION}")
 
     conn.commit()
 
@@ -126,39 +229,97 @@ def _get_meta(conn: sqlite3.Connection, key: str) -> str | None:
 
 
 def _set_meta(conn: sqlite3.Connection, key: str, val: str) -> None:
+    # không commit ở đây — caller gom các set_meta vào chung 1 transaction
     cur = conn.cursor()
     cur.execute("""
         INSERT INTO meta(k, v) VALUES(?, ?)
         ON CONFLICT(k) DO UPDATE SET v=excluded.v
     """, (key, val))
-    conn.commit()
 
 
 # UTILITIES 
 
-def _sha1(s: str) -> str:
-    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+def _sha1(s: str) -> bytes:
+    # digest thô 20 byte thay vì hex 40 ký tự: index hash nhỏ đi một nửa
+    # usedforsecurity=False: hash chỉ để content-address, bỏ wrapper FIPS
+    return hashlib.sha1(s.encode("utf-8"), usedforsecurity=False).digest()
 
 
 def _chunk_text_fields(ev: Dict) -> str:
-    """Ghép các trường có giá trị thành 1 đoạn văn để embedding."""
+    """Ghép các trường có giá trị thành 1 đoạn văn để embedding.
+    Unroll thẳng 8 trường (không loop + lookup tên trường) — hàm này chạy
+    1 lần/event nên interpreter overhead cộng dồn đáng kể với file lớn."""
+    d = ev.get
     fields = []
-    for k in ("date", "dow", "start", "end", "location", "participants", "title"):
-        v = ev.get(k)
-        if v:
-            fields.append(f"{k}: {v}")
-    if ev.get("raw"):
-        fields.append(f"raw: {ev['raw']}")
+    v = d("date")
+    if v: fields.append(f"date: {v}")
+    v = d("dow")
+    if v: fields.append(f"dow: {v}")
+    v = d("start")
+    if v: fields.append(f"start: {v}")
+    v = d("end")
+    if v: fields.append(f"end: {v}")
+    v = d("location")
+    if v: fields.append(f"location: {v}")
+    v = d("participants")
+    if v: fields.append(f"participants: {v}")
+    v = d("title")
+    if v: fields.append(f"title: {v}")
+    v = d("raw")
+    if v: fields.append(f"raw: {v}")
     return "\n".join(fields)
 
 
-def _load_events_texts(events: List[Dict]) -> List[Tuple[str, str, Dict]]:
-    """Trả về list (hash, text, ev)."""
+def _existing_hashes(cur: sqlite3.Cursor, hashes: List[bytes]) -> set:
+    """Trả về tập hash ĐÃ có trong chunks: đổ ứng viên vào temp table rồi
+    join với index unique — 1 câu SQL chạy trong C thay vì IN theo nhóm 900."""
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS _pending(hash BLOB PRIMARY KEY)")
+    cur.execute("DELETE FROM _pending")
+    cur.executemany("INSERT OR IGNORE INTO _pending VALUES(?)",
+                    ((h,) for h in hashes))
+    found = {h for (h,) in cur.execute(
+        "SELECT p.hash FROM _pending p JOIN chunks c ON c.hash = p.hash")}
+    cur.execute("DELETE FROM _pending")
+    # DML trên connection isolation_level="IMMEDIATE" đã mở BEGIN IMMEDIATE
+    # ngầm — commit ngay để nhả write-lock của store trước khi caller đi
+    # encode (có thể mất nhiều phút), web process còn ghi uploads/đọc chunks
+    cur.connection.commit()
+    return found
+
+
+_FIELD_KEYS = ("date", "dow", "start", "end", "location", "participants", "title", "raw")
+
+
+def _hash_event(ev: Dict) -> bytes:
+    """Hash đúng bytes của _chunk_text_fields(ev) nhưng feed hasher từng
+    mảnh — không dựng chuỗi ghép cho event rồi vứt đi nếu nó là bản sao."""
+    h = hashlib.sha1(usedforsecurity=False)
+    update = h.update
+    d = ev.get
+    first = True
+    for k in _FIELD_KEYS:
+        v = d(k)
+        if v:
+            if not first:
+                update(b"\n")
+            update(f"{k}: {v}".encode("utf-8"))
+            first = False
+    return h.digest()
+
+
+def _hash_events(events: List[Dict]) -> List[Tuple[bytes, Dict]]:
+    """Trả về list (hash, ev), khử trùng lặp ngay trong batch — bản sao
+    không bao giờ đi tới bước dựng text hay encode (tốn nhất trong pipeline)."""
+    hsh = _hash_event
     out = []
+    seen: set = set()
+    seen_add, out_append = seen.add, out.append
     for ev in events:
-        txt = _chunk_text_fields(ev)
-        h = _sha1(txt)
-        out.append((h, txt, ev))
+        h = hsh(ev)
+        if h in seen:
+            continue
+        seen_add(h)
+        out_append((h, ev))
     return out
 
 
@@ -172,14 +333,14 @@ def append_events(
 ) -> Dict:
     sqlite_path, faiss_path = _paths(store_dir)
 
-    conn = sqlite3.connect(sqlite_path)
+    conn = _connect(sqlite_path)
     _ensure_schema(conn)
     cur = conn.cursor()
 
     # backfill hash cho DB cũ (giúp dedupe hoạt động chuẩn)
     _backfill_hashes(conn)
 
-    model = SentenceTransformer(local_emb)
+    model = _get_model(local_emb, os.getenv("EMB_DEVICE"))
     try:
         dim = model.get_sentence_embedding_dimension()
     except Exception:
@@ -189,12 +350,17 @@ def append_events(
         index = faiss.read_index(faiss_path)
         n_old = index.ntotal
     else:
-        index = faiss.IndexFlatIP(dim)
+        index = _new_index(dim)
         n_old = 0
 
     # meta nhất quán
     prev_model = _get_meta(conn, "emb_model")
     prev_dim   = _get_meta(conn, "emb_dim")
+    prev_type  = _get_meta(conn, "index_type")
+    if n_old and prev_type != INDEX_TYPE:
+        # store cũ kiểu flat -> rebuild sang HNSW (không append được lên flat)
+        n_old = _rebuild_faiss_from_sqlite(conn, faiss_path, model)
+        index = faiss.read_index(faiss_path)
     if prev_model and prev_model != local_emb:
         # tự rebuild FAISS theo SQLite cho an toàn
         n_old = _rebuild_faiss_from_sqlite(conn, faiss_path, model)
@@ -203,28 +369,31 @@ def append_events(
         n_old = _rebuild_faiss_from_sqlite(conn, faiss_path, model)
         index = faiss.read_index(faiss_path)
 
-    # sanity: đồng bộ rows vs ntotal (tự-heal nếu lệch)
-    cur.execute("SELECT COUNT(*) FROM chunks")
-    rows_cnt_before = cur.fetchone()[0]
+    # sanity: đồng bộ rows vs ntotal (tự-heal nếu lệch); lấy luôn id kế tiếp —
+    # IDMap2 không đòi id liên tục nên MAX(id)+1 là đủ, không cần COUNT lại
+    cur.execute("SELECT COUNT(*), COALESCE(MAX(id)+1, 0) FROM chunks")
+    rows_cnt_before, next_id = cur.fetchone()
     if rows_cnt_before != n_old:
         n_old = _rebuild_faiss_from_sqlite(conn, faiss_path, model)
         index = faiss.read_index(faiss_path)
-        cur.execute("SELECT COUNT(*) FROM chunks")
-        rows_cnt_before = cur.fetchone()[0]
+        cur.execute("SELECT COUNT(*), COALESCE(MAX(id)+1, 0) FROM chunks")
+        rows_cnt_before, next_id = cur.fetchone()
 
-    # materialize records
-    pending = _load_events_texts(events)
+    # hash trước, text sau: chỉ dựng text cho record thực sự mới
+    pending = _hash_events(events)
 
     if dedupe:
-        existing = set(h for (h,) in cur.execute("SELECT hash FROM chunks") if h)
-        new_records = [(h, txt, ev) for (h, txt, ev) in pending if h not in existing]
+        existing = _existing_hashes(cur, [h for (h, _) in pending])
+        new_records = [(h, _chunk_text_fields(ev), ev)
+                       for (h, ev) in pending if h not in existing]
     else:
-        new_records = pending
+        new_records = [(h, _chunk_text_fields(ev), ev) for (h, ev) in pending]
 
     if not new_records:
-        _set_meta(conn, "emb_model", local_emb)
-        _set_meta(conn, "emb_dim", str(dim))
-        conn.commit(); conn.close()
+        with conn:
+            _set_meta(conn, "emb_model", local_emb)
+            _set_meta(conn, "emb_dim", str(dim))
+        conn.close()
         return {
             "added": 0,
             "total_before": rows_cnt_before,
@@ -235,50 +404,47 @@ def append_events(
 
     # encode + add
     texts = [r[1] for r in new_records]
-    embs = model.encode(texts, normalize_embeddings=True)
-    embs = np.asarray(embs, dtype="float32")
+    embs = _encode_texts(model, texts)
     if embs.shape[1] != dim:
         # rebuild rồi thử lại 1 lần
         _rebuild_faiss_from_sqlite(conn, faiss_path, model)
         index = faiss.read_index(faiss_path)
 
-    index.add(embs)
-    faiss.write_index(index, faiss_path)
+    index.add_with_ids(
+        embs, np.arange(next_id, next_id + len(new_records), dtype="int64")
+    )
+    _write_index_atomic(index, faiss_path)
 
     rows = []
     for i, (h, txt, ev) in enumerate(new_records):
-        rid = rows_cnt_before + i
+        rid = next_id + i
         rows.append((
             rid, txt,
             ev.get("date"), ev.get("dow"), ev.get("start"), ev.get("end"),
             ev.get("location"), ev.get("participants"), ev.get("title"), ev.get("raw"),
-            h
+            h, embs[i].tobytes()
         ))
-    cur.executemany("""
-        INSERT OR REPLACE INTO chunks(
-            id, text, date, dow, start, end, location, participants, title, raw, hash
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
-    """, rows)
-    conn.commit()
-
-    _set_meta(conn, "emb_model", local_emb)
-    _set_meta(conn, "emb_dim", str(dim))
-
-    cur.execute("SELECT COUNT(*) FROM chunks")
-    rows_cnt_after = cur.fetchone()[0]
-    # soft check: không “die”, chỉ cảnh báo nếu lệch
-    warn = None
-    if rows_cnt_after != index.ntotal:
-        warn = f"warning: sqlite_rows={rows_cnt_after} vs faiss_ntotal={index.ntotal}"
+    # insert rows + meta trong 1 transaction duy nhất (with conn: BEGIN/COMMIT)
+    with conn:
+        cur.executemany("""
+            INSERT OR REPLACE INTO chunks(
+                id, text, date, dow, start, end, location, participants, title, raw, hash, emb
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+        """, rows)
+        _set_meta(conn, "emb_model", local_emb)
+        _set_meta(conn, "emb_dim", str(dim))
+        _set_meta(conn, "index_type", INDEX_TYPE)
 
+    # không cần COUNT lại sau insert: add_with_ids + insert cùng dải id trong
+    # 1 transaction — nhất quán FAISS/SQLite giờ là cấu trúc, không phải check
     conn.close()
     return {
         "added": len(new_records),
         "total_before": rows_cnt_before,
-        "total_after": rows_cnt_after,
+        "total_after": rows_cnt_before + len(new_records),
         "sqlite_path": sqlite_path,
         "faiss_path": faiss_path,
-        "warning": warn
+        "warning": None
     }
 
 # rag/ingest_lib.py (chỉ phần rebuild_events)
@@ -289,40 +455,48 @@ def rebuild_events(events: list[dict], store_dir: str,
     import os, sqlite3, hashlib, numpy as np, faiss
     from sentence_transformers import SentenceTransformer
 
-    def sha1(s: str) -> str:
+    def sha1(s: str) -> bytes:
         import hashlib
-        return hashlib.sha1(s.encode("utf-8")).hexdigest()
+        return hashlib.sha1(s.encode("utf-8"), usedforsecurity=False).digest()
 
     sqlite_path = os.path.join(store_dir, "chunks.sqlite")
     faiss_path  = os.path.join(store_dir, "index.faiss")
     os.makedirs(store_dir, exist_ok=True)
 
-    # mở SQLite
-    conn = sqlite3.connect(sqlite_path)
+    # mở SQLite (WAL + pragmas cho bulk insert)
+    conn = _connect(sqlite_path)
     cur  = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS chunks(
       id INTEGER PRIMARY KEY,
-      hash TEXT UNIQUE,
+      hash BLOB UNIQUE,
       text TEXT,
       date TEXT, dow TEXT, start TEXT, end TEXT,
-      location TEXT, participants TEXT, title TEXT, raw TEXT
+      location TEXT, participants TEXT, title TEXT, raw TEXT,
+      emb BLOB
     )""")
     cur.execute("""CREATE TABLE IF NOT EXISTS meta(k TEXT PRIMARY KEY, v TEXT)""")
+    cur.execute("PRAGMA table_info(chunks)")
+    if "emb" not in {r[1] for r in cur.fetchall()}:
+        cur.execute("ALTER TABLE chunks ADD COLUMN emb BLOB")
     conn.commit()
 
+    # vớt embedding cũ theo hash TRƯỚC khi clear — phần nội dung không đổi
+    # giữa 2 lần rebuild sẽ không phải encode lại (chỉ hợp lệ cùng model)
+    cached_embs: dict = {}
+    prev_model = cur.execute("SELECT v FROM meta WHERE k='emb_model'").fetchone()
+    if prev_model and prev_model[0] == local_emb:
+        cached_embs = {
+            h: e for (h, e) in cur.execute(
+                "SELECT hash, emb FROM chunks WHERE emb IS NOT NULL")
+        }
+
     # clear dữ liệu cũ
     cur.execute("DELETE FROM chunks")
     conn.commit()
 
-    # chuẩn bị texts + dedupe theo hash
-    def materialize_text(ev):
-        parts=[]
-        for k in ("date","dow","start","end","location","participants","title"):
-            v=ev.get(k)
-            if v: parts.append(f"{k}: {v}")
-        if ev.get("raw"): parts.append(f"raw: {ev['raw']}")
-        return "\n".join(parts)
+    # chuẩn bị texts + dedupe theo hash (dùng chung formatter unrolled)
+    materialize_text = _chunk_text_fields
 
     records=[]
     if dedupe:
@@ -340,34 +514,42 @@ def rebuild_events(events: list[dict], store_dir: str,
             h   = sha1(txt)
             records.append((h, txt, ev))
 
-    # tạo FAISS mới
-    model = SentenceTransformer(local_emb)
+    # tạo FAISS mới (HNSW + IDMap2, id = 0..n-1 khớp rowid)
+    model = _get_model(local_emb, os.getenv("EMB_DEVICE"))
     dim   = model.get_sentence_embedding_dimension()
-    index = faiss.IndexFlatIP(dim)
-
-    # encode + add
-    texts = [r[1] for r in records]
-    if texts:
-        embs  = model.encode(texts, normalize_embeddings=True)
-        embs  = np.asarray(embs, dtype="float32")
-        index.add(embs)
-    faiss.write_index(index, faiss_path)
-
-    # insert rows với id khớp thứ tự index
-    for i, (h, txt, ev) in enumerate(records):
-        cur.execute("""INSERT OR REPLACE INTO chunks(
-            id, hash, text, date, dow, start, end, location, participants, title, raw
-        ) VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
-        (i, h, txt, ev.get("date"), ev.get("dow"), ev.get("start"), ev.get("end"),
-         ev.get("location"), ev.get("participants"), ev.get("title"), ev.get("raw")))
-    conn.commit()
-
-    # lưu meta
-    cur.execute("INSERT INTO meta(k,v) VALUES('emb_model',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
-                (local_emb,))
-    cur.execute("INSERT INTO meta(k,v) VALUES('emb_dim',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
-                (str(dim),))
-    conn.commit()
+    index = _new_index(dim)
+
+    # encode + add — chỉ encode các hash chưa có embedding cache
+    embs = np.empty((len(records), dim), dtype=np.float32)
+    if records:
+        missing = []
+        for i, (h, _txt, _ev) in enumerate(records):
+            e = cached_embs.get(h)
+            if e is not None and len(e) == dim * 4:
+                embs[i] = np.frombuffer(e, dtype=np.float32)
+            else:
+                missing.append(i)
+        if missing:
+            embs[missing] = _encode_texts(model, [records[i][1] for i in missing])
+        index.add_with_ids(np.ascontiguousarray(embs),
+                           np.arange(len(records), dtype="int64"))
+    _write_index_atomic(index, faiss_path)
+
+    # insert rows (id khớp thứ tự index) + meta trong 1 transaction duy nhất
+    with conn:
+        cur.executemany("""INSERT OR REPLACE INTO chunks(
+            id, hash, text, date, dow, start, end, location, participants, title, raw, emb
+        ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
+        [(i, h, txt, ev.get("date"), ev.get("dow"), ev.get("start"), ev.get("end"),
+          ev.get("location"), ev.get("participants"), ev.get("title"), ev.get("raw"),
+          embs[i].tobytes())
+         for i, (h, txt, ev) in enumerate(records)])
+        cur.execute("INSERT INTO meta(k,v) VALUES('emb_model',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                    (local_emb,))
+        cur.execute("INSERT INTO meta(k,v) VALUES('emb_dim',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                    (str(dim),))
+        cur.execute("INSERT INTO meta(k,v) VALUES('index_type',?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
+                    (INDEX_TYPE,))
 
     # kiểm tra “mềm” và trả summary
     rows_cnt = cur.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
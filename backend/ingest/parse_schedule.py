@@ -2,6 +2,7 @@
 
 import argparse, json, re, datetime as dt
 from docx import Document
+from docx.oxml.ns import qn
 
 # =========================
 # Regex cho các thành phần
@@ -16,6 +17,15 @@ RE_ALLDAY    = re.compile(r"\b(cả\s*ngày)\b", re.IGNORECASE)
 RE_ONLINE    = re.compile(r"\b(trực tuyến|online)\b", re.IGNORECASE)
 RE_PLATFORM  = re.compile(r"(MS\s*Teams?|MSTeams?|MSTeam|Zoom|Google\s*Meet|Google\s*Meeting)", re.IGNORECASE)
 
+# Các pattern phụ chạy trên mỗi event — compile 1 lần ở module scope,
+# không re.sub với pattern chữ trong vòng lặp nóng
+RE_WS        = re.compile(r"\s+")
+RE_BULLET    = re.compile(r"^[*•]\s*")
+RE_LEAD_TIME = re.compile(r"^\d{1,2}(?:(?::|[hH])\s?\d{0,2})?\s*(?:-|–|—)?\s*")
+RE_TP_TAIL   = re.compile(r"\s*(TP|Thành phần)\s*[:\-].*$", re.IGNORECASE)
+RE_VIA_SOFT  = re.compile(r"\bqua\s+phần\s+mềm\s*:?\s*", re.IGNORECASE)
+RE_LOC_TAIL  = re.compile(r"[,\-–—]\s*$")
+
 # Chuẩn hoá
 # Bản đồ chuẩn hoá tên platform (chấp nhận có/không dấu cách)
 PLATFORM_MAP = {
@@ -30,11 +40,11 @@ PLATFORM_MAP = {
 
 def norm(s: str) -> str:
     """Rút gọn khoảng trắng dư thừa."""
-    return re.sub(r"\s+", " ", (s or "")).strip()
+    return RE_WS.sub(" ", (s or "")).strip()
 
 def _platform_key(s: str) -> str:
     """Chuẩn hoá key platform để tra map (hạ chữ + loại bỏ khoảng trắng thừa)."""
-    return re.sub(r"\s+", " ", (s or "")).strip().lower().replace(" ", "")
+    return RE_WS.sub(" ", (s or "")).strip().lower().replace(" ", "")
 
 def title_case_location(s: str) -> str:
     """
@@ -109,11 +119,11 @@ def split_events(text: str) -> list[list[str]]:
 
 def _clean_title(text: str) -> str:
     """Làm sạch tiêu đề: bỏ bullet, bỏ tiền tố giờ, bỏ 'TP:' kéo theo."""
-    t = re.sub(r"^[*•]\s*", "", text).strip()
-    t = re.sub(r"^\d{1,2}(?:(?::|[hH])\s?\d{0,2})?\s*(?:-|–|—)?\s*", "", t)  # bỏ giờ đầu câu
-    t = re.sub(r"\s*(TP|Thành phần)\s*[:\-].*$", "", t, flags=re.IGNORECASE).strip()
+    t = RE_BULLET.sub("", text).strip()
+    t = RE_LEAD_TIME.sub("", t)  # bỏ giờ đầu câu
+    t = RE_TP_TAIL.sub("", t).strip()
     # bỏ cụm "qua phần mềm"
-    t = re.sub(r"\bqua\s+phần\s+mềm\s*:?\s*", "", t, flags=re.IGNORECASE).strip()
+    t = RE_VIA_SOFT.sub("", t).strip()
     return norm(t)
 
 def parse_event_lines(lines: list[str]) -> dict:
@@ -140,7 +150,7 @@ def parse_event_lines(lines: list[str]) -> dict:
     mloc = RE_LOC.search(full)
     if mloc:
         loc = norm(mloc.group("loc"))
-        loc = re.sub(r"[,\-–—]\s*$", "", loc)
+        loc = RE_LOC_TAIL.sub("", loc)
         after_loc = full[mloc.end():]
         title_source = norm(after_loc)
     else:
@@ -182,6 +192,38 @@ def parse_event_lines(lines: list[str]) -> dict:
         "raw": full,
     }
 
+def _iter_table_rows(doc: Document):
+    """Duyệt thẳng XML của bảng (w:tr/w:tc/w:t) thay vì t.rows/r.cells:
+    python-docx dựng wrapper _Row/_Cell cho từng ô, rất tốn với bảng lớn.
+    Text mỗi ô: các paragraph nối '\\n'. Ô merge được trải ra như row.cells:
+    gridSpan lặp text theo số cột, vMerge tiếp diễn lấy lại text của ô anchor
+    hàng trên — cột Ngày merge dọc (layout lịch tuần điển hình) vẫn ra đủ."""
+    for t in doc.tables:
+        prev: list[str] = []
+        for tr in t._tbl.iterfind(qn("w:tr")):
+            cells: list[str] = []
+            for tc in tr.iterfind(qn("w:tc")):
+                span, vmerge = 1, None
+                tcpr = tc.find(qn("w:tcPr"))
+                if tcpr is not None:
+                    gs = tcpr.find(qn("w:gridSpan"))
+                    if gs is not None:
+                        span = int(gs.get(qn("w:val")) or 1)
+                    vm = tcpr.find(qn("w:vMerge"))
+                    if vm is not None:
+                        # <w:vMerge/> không có val nghĩa là "continue"
+                        vmerge = vm.get(qn("w:val")) or "continue"
+                if vmerge == "continue":
+                    text = prev[len(cells)] if len(cells) < len(prev) else ""
+                else:
+                    text = "\n".join(
+                        "".join(wt.text or "" for wt in p.iter(qn("w:t")))
+                        for p in tc.iter(qn("w:p"))
+                    )
+                cells.extend([text] * span)
+            prev = cells
+            yield cells
+
 def infer_year_from_doc(doc: Document) -> int | None:
     """Dò năm mặc định từ bất kỳ ngày có năm trong file."""
     for p in doc.paragraphs:
@@ -189,38 +231,36 @@ def infer_year_from_doc(doc: Document) -> int | None:
         if m and m.group(3):
             y = int(m.group(3))
             return (2000 + y) if y < 100 else y
-    for tb in doc.tables:
-        for row in tb.rows:
-            for cell in row.cells:
-                m = RE_DDMM.search(cell.text)
-                if m and m.group(3):
-                    y = int(m.group(3))
-                    return (2000 + y) if y < 100 else y
+    for cells in _iter_table_rows(doc):
+        for text in cells:
+            m = RE_DDMM.search(text)
+            if m and m.group(3):
+                y = int(m.group(3))
+                return (2000 + y) if y < 100 else y
     return None
 
 def parse_docx_as_table(path: str, default_year: int | None) -> list[dict]:
     """Parse toàn bộ docx dạng bảng 2 cột (Ngày | Công việc)."""
     doc = Document(path)
     results = []
-    for t in doc.tables:
-        for r in t.rows:
-            if len(r.cells) < 2:
-                continue
-            day_text, work_text = r.cells[0].text, r.cells[1].text
-            dow, the_date = parse_header_date(day_text, default_year)
-            # Bỏ các hàng tiêu đề/rỗng không có DOW/DATE
-            if not (dow or the_date):
-                continue
-
-            blocks = split_events(work_text)
-            if not blocks:
-                blocks = [[work_text]]
-
-            for b in blocks:
-                ev = parse_event_lines(b)
-                ev["date"] = the_date
-                ev["dow"]  = norm(dow) if dow else None
-                results.append(ev)
+    for cells in _iter_table_rows(doc):
+        if len(cells) < 2:
+            continue
+        day_text, work_text = cells[0], cells[1]
+        dow, the_date = parse_header_date(day_text, default_year)
+        # Bỏ các hàng tiêu đề/rỗng không có DOW/DATE
+        if not (dow or the_date):
+            continue
+
+        blocks = split_events(work_text)
+        if not blocks:
+            blocks = [[work_text]]
+
+        for b in blocks:
+            ev = parse_event_lines(b)
+            ev["date"] = the_date
+            ev["dow"]  = norm(dow) if dow else None
+            results.append(ev)
     return results
 
 if __name__ == "__main__":
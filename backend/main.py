@@ -40,12 +40,17 @@ app.add_middleware(
 if FRONT_USER.exists():
     app.mount("/assets", StaticFiles(directory=FRONT_USER, html=False), name="user-assets")
 
+# Resolve path + stat 1 lần lúc startup — mỗi request không tốn syscall exists()
+_INDEX_PATH    = FRONT_USER / "index.html"
+_INDEX_EXISTS  = _INDEX_PATH.exists()
+_FAVICON_PATH  = FRONT_USER / "favicon.ico"
+_FAVICON_EXISTS = _FAVICON_PATH.exists()
+
 # Luôn có route "/" để tránh 404 khi UI chưa sẵn
 @app.get("/")
 def user_index():
-    idx = FRONT_USER / "index.html"
-    if idx.exists():
-        return FileResponse(idx)
+    if _INDEX_EXISTS:
+        return FileResponse(_INDEX_PATH)
     return {
         "message": "User UI chưa sẵn. Hãy đặt file vào frontend/user/index.html (kèm main.js, style.css)."
     }
@@ -53,9 +58,8 @@ def user_index():
 # Favicon (tránh spam 404 trong log)
 @app.get("/favicon.ico")
 def favicon():
-    fav = FRONT_USER / "favicon.ico"
-    if fav.exists():
-        return FileResponse(fav)
+    if _FAVICON_EXISTS:
+        return FileResponse(_FAVICON_PATH)
     return Response(status_code=204)
 
 # ====================
@@ -68,19 +72,15 @@ if FRONT_ADMIN.exists():
 # ===============
 # Include API Routers
 # ===============
+# Import thẳng, không bọc try/except: router hỏng thì fail ngay lúc khởi động
+# với traceback thật, thay vì app chạy "thiếu API" âm thầm.
 # /api/chat
-try:
-    from backend.api.user_api import router as user_router
-    app.include_router(user_router)
-except Exception:
-    pass
+from backend.api.user_api import router as user_router
+app.include_router(user_router)
 
 # /api/admin/*
-try:
-    from backend.api.admin_api import router as admin_router
-    app.include_router(admin_router)
-except Exception:
-    pass
+from backend.api.admin_api import router as admin_router
+app.include_router(admin_router)
 
 # =================
 # Health & Version
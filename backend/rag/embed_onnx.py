@@ -0,0 +1,76 @@
+# rag/embed_onnx.py — encoder ONNX Runtime int8 (backend tuỳ chọn cho ingest)
+#
+# Bật qua env EMB_BACKEND=onnx. Cần các gói tuỳ chọn:
+#   pip install optimum[onnxruntime] onnxruntime
+# Lần chạy đầu export model sang ONNX + quantize dynamic int8, cache cạnh
+# HF cache (~/.cache); các lần sau chỉ load session.
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+
+class OnnxEncoder:
+    """Thay thế SentenceTransformer.encode cho ingest: tokenize bằng
+    AutoTokenizer, chạy InferenceSession int8, mean-pool theo attention_mask.
+    Giữ cùng giao diện encode()/get_sentence_embedding_dimension() để
+    _encode_texts dùng lẫn được."""
+
+    def __init__(self, model_name: str, cache_dir: Optional[str] = None):
+        try:
+            import onnxruntime as ort
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "EMB_BACKEND=onnx cần optimum[onnxruntime]; "
+                "pip install optimum[onnxruntime] onnxruntime"
+            ) from e
+
+        cache_dir = cache_dir or os.path.join(
+            os.path.expanduser("~"), ".cache", "weekly_bot_onnx",
+            model_name.replace("/", "__"))
+        qpath = Path(cache_dir) / "model_quantized.onnx"
+
+        if not qpath.exists():
+            # export + quantize dynamic int8, chỉ tốn 1 lần
+            model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+            model.save_pretrained(cache_dir)
+            quantizer = ORTQuantizer.from_pretrained(cache_dir)
+            qconfig = AutoQuantizationConfig.avx2(is_static=False)
+            quantizer.quantize(save_dir=cache_dir, quantization_config=qconfig)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.session = ort.InferenceSession(
+            str(qpath), providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        # dim lấy từ 1 forward pass thử
+        self._dim = int(self._forward(["x"]).shape[1])
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self._dim
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        enc = self.tokenizer(
+            texts, padding="longest", truncation=True, return_tensors="np")
+        feeds = {k: v for k, v in enc.items() if k in self._input_names}
+        hidden = self.session.run(None, feeds)[0]  # (B, T, H)
+        mask = enc["attention_mask"][..., None].astype(np.float32)
+        # mean-pool theo attention_mask (giống pooling của MiniLM gốc)
+        summed = (hidden * mask).sum(axis=1)
+        counts = np.clip(mask.sum(axis=1), 1e-9, None)
+        return (summed / counts).astype(np.float32)
+
+    def encode(self, texts: List[str], batch_size: int = 32, **_ignored) -> np.ndarray:
+        """Giao diện tối thiểu tương thích SentenceTransformer.encode;
+        các kwarg kiểu convert_to_numpy/show_progress_bar được bỏ qua.
+        KHÔNG tự normalize — caller (faiss.normalize_L2) lo việc đó."""
+        out = [
+            self._forward(texts[i:i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+        return np.concatenate(out, axis=0) if out else np.empty((0, self._dim), np.float32)
@@ -1,6 +1,10 @@
 # rag/io_store.py
 from __future__ import annotations
+import os
 import sqlite3
+import threading
+import time
+from contextlib import closing
 from typing import Dict, List, Optional, Tuple
 import faiss, numpy as np
 from functools import lru_cache
@@ -8,21 +12,23 @@ from functools import lru_cache
 from .settings import SQLITE_PATH, FAISS_PATH, LOCAL_EMB_MODEL
 
 # SQLite
+# closing(...) đảm bảo FD được trả lại kể cả khi query ném exception
 def get_events_by_date(date_str: str) -> List[Dict]:
-    conn = sqlite3.connect(SQLITE_PATH); cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT id, text, date, dow, start, end, location, participants, title, raw
-        FROM chunks
-        WHERE date = ?
-        ORDER BY 
-            CASE WHEN start IS NULL OR TRIM(start)='' THEN 1 ELSE 0 END,
-            start,
-            id
-        """,
-        (date_str,),
-    )
-    rows = cur.fetchall(); conn.close()
+    with closing(sqlite3.connect(SQLITE_PATH)) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, text, date, dow, start, end, location, participants, title, raw
+            FROM chunks
+            WHERE date = ?
+            ORDER BY
+                CASE WHEN start IS NULL OR TRIM(start)='' THEN 1 ELSE 0 END,
+                start,
+                id
+            """,
+            (date_str,),
+        )
+        rows = cur.fetchall()
     return [
         {"id": r[0], "text": r[1], "date": r[2], "dow": r[3], "start": r[4],
          "end": r[5], "location": r[6], "participants": r[7], "title": r[8], "raw": r[9]}
@@ -30,37 +36,101 @@ def get_events_by_date(date_str: str) -> List[Dict]:
     ]
 
 def list_all_dates() -> List[str]:
-    conn = sqlite3.connect(SQLITE_PATH); cur = conn.cursor()
-    cur.execute("SELECT DISTINCT date FROM chunks"); dates = [r[0] for r in cur.fetchall() if r[0]]
-    conn.close()
+    with closing(sqlite3.connect(SQLITE_PATH)) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT date FROM chunks")
+        dates = [r[0] for r in cur.fetchall() if r[0]]
     return dates
 
 def _fetch_all_date_dow_pairs() -> List[Tuple[str, str]]:
-    conn = sqlite3.connect(SQLITE_PATH); cur = conn.cursor()
-    cur.execute("SELECT DISTINCT date, dow FROM chunks"); pairs = cur.fetchall()
-    conn.close()
+    with closing(sqlite3.connect(SQLITE_PATH)) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT date, dow FROM chunks")
+        pairs = cur.fetchall()
     return [(d, dw) for (d, dw) in pairs if d and dw]
 
 # ---------- FAISS ----------
-_index = faiss.read_index(FAISS_PATH)
+# mmap read-only: page-in theo nhu cầu thay vì đọc cả file lúc import;
+# ingest thay file bằng os.replace nên bản đang map không bao giờ bị ghi đè dở
+try:
+    _index = faiss.read_index(FAISS_PATH, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+except RuntimeError:
+    # loại index không hỗ trợ mmap -> đọc thẳng như cũ
+    _index = faiss.read_index(FAISS_PATH)
+try:
+    # store mới là IDMap2(HNSW): chỉnh efSearch cho cân bằng recall/latency
+    faiss.downcast_index(_index.index).hnsw.efSearch = 64
+except Exception:
+    pass  # store cũ kiểu flat vẫn search được như trước
 
 @lru_cache(maxsize=1)
 def _st_model():
     from sentence_transformers import SentenceTransformer
     return SentenceTransformer(LOCAL_EMB_MODEL)
 
+# cửa sổ gom batch (ms); 0 = chỉ nhường lượt scheduler, gần như không chờ
+_BATCH_WINDOW_MS = float(os.getenv("SEARCH_BATCH_WINDOW_MS", "8"))
+
+class _SearchBatcher:
+    """Gom các vector_search chạy đồng thời (mỗi request một thread trong
+    threadpool của FastAPI) thành 1 lần encode + 1 lần index.search.
+    Thread đầu tiên làm leader: chờ hết cửa sổ, xử lý cả batch rồi đánh thức
+    các thread còn lại — FAISS search theo batch nhanh hơn hẳn từng vector."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queue: List[Dict] = []
+        self._has_leader = False
+
+    def search(self, q: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        item: Dict = {"q": q, "k": k, "done": threading.Event(), "out": None, "err": None}
+        with self._lock:
+            self._queue.append(item)
+            is_leader = not self._has_leader
+            if is_leader:
+                self._has_leader = True
+        if not is_leader:
+            item["done"].wait()
+            if item["err"] is not None:
+                raise item["err"]
+            return item["out"]
+
+        time.sleep(_BATCH_WINDOW_MS / 1000.0)
+        with self._lock:
+            batch, self._queue = self._queue, []
+            self._has_leader = False
+
+        # leader hỏng (model chưa load, index lỗi...) vẫn PHẢI đánh thức cả
+        # batch, kèm exception cho từng item — không thì follower wait() mãi,
+        # giữ chết thread của threadpool Starlette
+        try:
+            kmax = max(it["k"] for it in batch)
+            V = _st_model().encode([it["q"] for it in batch], normalize_embeddings=True)
+            D, I = _index.search(
+                np.ascontiguousarray(np.asarray(V, dtype="float32")), kmax)
+        except BaseException as e:
+            for it in batch:
+                it["err"] = e
+                it["done"].set()
+            raise
+        for row, it in enumerate(batch):
+            it["out"] = (D[row], I[row])
+            it["done"].set()
+        return item["out"]
+
+_BATCHER = _SearchBatcher()
+
 def vector_search(q: str, k: int = 10) -> List[Dict]:
-    v = _st_model().encode([q], normalize_embeddings=True)
-    D, I = _index.search(np.asarray(v, dtype="float32"), k)
+    D, I = _BATCHER.search(q, k)
     rows = []
-    conn = sqlite3.connect(SQLITE_PATH); cur = conn.cursor()
-    for idx, score in zip(I[0].tolist(), D[0].tolist()):
-        cur.execute("""SELECT id,text,date,dow,start,end,location,participants,title,raw 
-                       FROM chunks WHERE id=?""", (int(idx),))
-        r = cur.fetchone()
-        if r:
-            rows.append({"id": r[0], "text": r[1], "date": r[2], "dow": r[3], "start": r[4],
-                         "end": r[5], "location": r[6], "participants": r[7], "title": r[8],
-                         "raw": r[9], "score": float(score)})
-    conn.close()
+    with closing(sqlite3.connect(SQLITE_PATH)) as conn:
+        cur = conn.cursor()
+        for idx, score in zip(I.tolist()[:k], D.tolist()[:k]):
+            cur.execute("""SELECT id,text,date,dow,start,end,location,participants,title,raw
+                           FROM chunks WHERE id=?""", (int(idx),))
+            r = cur.fetchone()
+            if r:
+                rows.append({"id": r[0], "text": r[1], "date": r[2], "dow": r[3], "start": r[4],
+                             "end": r[5], "location": r[6], "participants": r[7], "title": r[8],
+                             "raw": r[9], "score": float(score)})
     return rows
\ No newline at end of file
@@ -1,9 +1,12 @@
 # rag/parser.py — TMU Weekly (state-machine parser, finalized)
 from __future__ import annotations
 import re
+import zipfile
 import datetime as dt
-from typing import List, Dict, Optional, Tuple
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from docx import Document
+from lxml import etree
 
 # Regex
 RE_DOW_HDR    = re.compile(r"\b(Thứ\s*[2-7]|Chủ\s*nhật|CN|cn|thu\s*[2-7])\b", re.I)
@@ -20,12 +23,23 @@ RE_TIME_RANGE = re.compile(
     re.I
 )
 
+# gộp 3 pattern giờ thành 1 alternation: strip giờ khỏi title trong 1 lần quét
+# (thứ tự range -> hh:mm -> hh để nhánh dài match trước)
+RE_ALL_TIMES  = re.compile(
+    "|".join(f"(?:{p.pattern})" for p in (RE_TIME_RANGE, RE_HHMM, RE_HH)),
+    re.I
+)
+
 # location tag & bullets
 RE_LOC_TAG    = re.compile(r"\b(địa\s*điểm\s*[:：]|tại)\b", re.I)
 RE_BULLET     = re.compile(r"^[\*\-\u2022]+\s*")
 
 # TP / Thành phần / Mời dự
 RE_TP         = re.compile(r"^(TP|Thành\s*phần|Mời\s*dự)\s*[:：\-]\s*(.+)$", re.I)
+RE_TP_INLINE  = re.compile(r"\b(Thành\s*phần|TP|Mời\s*dự)\b", re.I)
+
+# số thứ trong "Thứ X" / "thu X"
+RE_DOW_NUM    = re.compile(r"[2-7]")
 
 DOW_VI = ["Thứ 2","Thứ 3","Thứ 4","Thứ 5","Thứ 6","Thứ 7","Chủ nhật"]
 
@@ -68,38 +82,126 @@ def _norm_time(s: str) -> Tuple[Optional[str], Optional[str]]:
         return f"{int(hh.group(1)):02d}:00", None
     return None, None
 
-def infer_year_from_doc(doc: Document) -> Optional[int]:
-    # đoán năm xuất hiện trong file
-    def _scan(text: str) -> Optional[int]:
-        for m in re.finditer(r"\b(20\d{2})\b", text):
-            y = int(m.group(1))
-            if 2000 <= y <= 2100:
-                return y
-        return None
-    y = _scan(" ".join(p.text for p in doc.paragraphs))
-    if y: return y
-    for tb in doc.tables:
-        for r in tb.rows:
-            y = _scan(" | ".join(c.text for c in r.cells))
-            if y: return y
+# Streaming DOCX (fast-path)
+# python-docx dựng cả DOM lxml cho document.xml; với bảng lớn thì iterparse
+# từng <w:tr> rồi clear() rẻ hơn nhiều (O(1) bộ nhớ theo hàng).
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+RE_YEAR = re.compile(r"\b(20\d{2})\b")
+
+def _iter_docx_table_rows(path: str) -> Iterator[List[str]]:
+    """Stream từng hàng bảng trong document.xml, trả list text theo ô.
+    Text trong 1 ô: các paragraph nối bằng '\\n' (giống row.cells[i].text).
+    Ô gridSpan lặp text theo số cột như row.cells — hàng full-width không
+    mất cột phải (state machine phía trên đã tự xử lý vMerge qua ô rỗng)."""
+    with zipfile.ZipFile(path) as z, z.open("word/document.xml") as f:
+        for _, tr in etree.iterparse(f, tag=_W + "tr", events=("end",)):
+            cells = []
+            for tc in tr.iterfind(_W + "tc"):
+                paras = [
+                    "".join(t.text or "" for t in p.iter(_W + "t"))
+                    for p in tc.iter(_W + "p")
+                ]
+                span = 1
+                tcpr = tc.find(_W + "tcPr")
+                if tcpr is not None:
+                    gs = tcpr.find(_W + "gridSpan")
+                    if gs is not None:
+                        span = int(gs.get(_W + "val") or 1)
+                cells.extend(["\n".join(paras)] * span)
+            yield cells
+            tr.clear()
+            while tr.getprevious() is not None:
+                del tr.getparent()[0]
+
+def infer_year_from_docx(path: str) -> Optional[int]:
+    """Bản streaming của infer_year_from_doc: quét <w:t> tới khi gặp năm."""
+    with zipfile.ZipFile(path) as z, z.open("word/document.xml") as f:
+        for _, t in etree.iterparse(f, tag=_W + "t", events=("end",)):
+            m = RE_YEAR.search(t.text or "")
+            if m:
+                return int(m.group(1))
+            t.clear()
     return None
 
+def infer_year_from_doc(doc: Document) -> Optional[int]:
+    # đoán năm xuất hiện trong file: gom paragraphs + cells thành 1 chuỗi,
+    # quét regex đúng 1 lần (paragraphs đứng trước nên vẫn ưu tiên như cũ)
+    all_text = "\n".join(chain(
+        (p.text for p in doc.paragraphs),
+        (c.text for tb in doc.tables for r in tb.rows for c in r.cells),
+    ))
+    m = RE_YEAR.search(all_text)
+    return int(m.group(1)) if m else None
+
 # Core Parser
 def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[Dict]:
     """
-    Parser chuyên TMU:
+    Fast-path theo path: stream hàng bảng qua lxml.iterparse, không dựng DOM
+    python-docx. File không có bảng -> fallback bản Document (đọc paragraphs).
+    """
+    year = default_year or infer_year_from_docx(path) or dt.date.today().year
+    events = _parse_lines(_iter_docx_table_rows(path), (), year)
+    if events:
+        return events
+    return parse_docx_as_table_from_doc(Document(path), year)
+
+
+def parse_docx_as_table_from_doc(doc: Document, default_year: Optional[int] = None) -> List[Dict]:
+    """Bản nhận Document đã mở (python-docx) — dùng khi đã có sẵn doc."""
+    year = default_year or infer_year_from_doc(doc) or dt.date.today().year
+    table_rows = (
+        [c.text for c in row.cells]
+        for tb in doc.tables for row in tb.rows
+    )
+    return _parse_lines(table_rows, (p.text for p in doc.paragraphs), year)
+
+
+def parse_docx_as_table_iter(path: str, default_year: Optional[int] = None) -> Iterator[Dict]:
+    """Bản lazy của parse_docx_as_table: yield từng event ngay khi chốt xong.
+    Preview chỉ cần islice N event đầu -> chi phí O(N) bất kể file to cỡ nào."""
+    year = default_year or infer_year_from_docx(path) or dt.date.today().year
+    saw_event = False
+    for ev in _iter_parse_lines(_iter_docx_table_rows(path), (), year):
+        saw_event = True
+        yield ev
+    if not saw_event:
+        # không có bảng/không ra event -> fallback paragraphs qua python-docx
+        doc = Document(path)
+        yield from _iter_parse_lines((), (p.text for p in doc.paragraphs), year)
+
+
+def _parse_lines(table_rows: Iterable[List[str]], paragraphs: Iterable[str],
+                 year: int) -> List[Dict]:
+    return list(_iter_parse_lines(table_rows, paragraphs, year))
+
+
+def _iter_parse_lines(table_rows: Iterable[List[str]], paragraphs: Iterable[str],
+                      year: int) -> Iterator[Dict]:
+    """
+    Parser chuyên TMU (state machine trên các hàng bảng 2 cột):
       - Cột trái: 'Thứ X' + 'dd/mm'
       - Cột phải: từng dòng/bullet là một sự kiện
       - Dòng 'TP/Thành phần/Mời dự' ghép vào event trước đó
-    Trả về: [{date,dow,start,end,location,participants,title,raw}]
+      - Không có hàng bảng nào -> duyệt paragraphs
+    Yield: {date,dow,start,end,location,participants,title,raw}
+    Event chỉ được yield khi có event mới hơn xuất hiện (TP chỉ có thể ghép
+    vào event mới nhất) nên đệm tối đa 1 event — streaming an toàn.
     """
-    doc  = Document(path)
-    year = default_year or infer_year_from_doc(doc) or dt.date.today().year
-
-    events: List[Dict] = []
+    pending: List[Dict] = []  # đệm 1 event đang chờ TP
     cur_date: Optional[str] = None
     cur_dow:  Optional[str] = None
-    last_event_idx: Optional[int] = None
+
+    def _finalize(e: Dict) -> Optional[Dict]:
+        # lọc rác & bổ sung DOW từ date nếu thiếu
+        if not (e.get("title") or e.get("start") or e.get("date")):
+            return None
+        if not e.get("dow") and e.get("date"):
+            try:
+                d = dt.datetime.strptime(e["date"], "%d/%m/%Y").date()
+                e["dow"] = _dow_vi(d)
+            except Exception:
+                pass
+        return e
 
     def _scan_day_and_date(s: str) -> bool:
         nonlocal cur_date, cur_dow
@@ -116,18 +218,17 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
                 if "chủ nhật" in w or w in ("cn","CN"):
                     cur_dow = "Chủ nhật"
                 else:
-                    num = re.search(r"[2-7]", w)
+                    num = RE_DOW_NUM.search(w)
                     cur_dow = f"Thứ {num.group(0)}" if num else None
                 return True
         return False
 
     def _flush_tp(tp_text: str):
-        nonlocal last_event_idx
-        if last_event_idx is None:
+        if not pending:
             return
         tp_text = _smart_cap(tp_text.strip(" .;"))
-        prev = events[last_event_idx].get("participants")
-        events[last_event_idx]["participants"] = f"{prev}; {tp_text}" if prev else tp_text
+        prev = pending[-1].get("participants")
+        pending[-1]["participants"] = f"{prev}; {tp_text}" if prev else tp_text
 
     def _extract_location(full_text: str) -> Tuple[Optional[str], Optional[Tuple[int,int]]]:
         m = RE_LOC_TAG.search(full_text)
@@ -136,7 +237,7 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
         tail = full_text[m.end():].strip()
         # cắt trước phần TP/Thành phần nếu có
         cut_at = None
-        tp_pos = re.search(r"\b(Thành\s*phần|TP|Mời\s*dự)\b", tail, re.I)
+        tp_pos = RE_TP_INLINE.search(tail)
         if tp_pos:
             cut_at = tp_pos.start()
         else:
@@ -148,7 +249,6 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
         return (loc or None), (m.start(), m.end())
 
     def _emit_event(raw_line: str):
-        nonlocal last_event_idx
         raw = " ".join(raw_line.split())
         raw = RE_BULLET.sub("", raw)
         if not raw:
@@ -157,10 +257,8 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
         start, end = _norm_time(raw)
         location, loc_span = _extract_location(raw)
 
-        # title: bỏ giờ + bỏ cụm "tại/địa điểm"
-        title = RE_TIME_RANGE.sub("", raw)
-        title = RE_HHMM.sub("", title)
-        title = RE_HH.sub("", title)
+        # title: bỏ giờ (1 lần quét cho cả 3 dạng) + bỏ cụm "tại/địa điểm"
+        title = RE_ALL_TIMES.sub("", raw)
         if loc_span:
             title = title[:loc_span[0]] + title[loc_span[1]:]
         title = _smart_cap(title.strip(" ,;–—|-"))
@@ -175,34 +273,19 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
             "title": title if title else None,
             "raw": raw_line.strip()
         }
-        events.append(ev)
-        last_event_idx = len(events) - 1
+        pending.append(ev)
 
     # Scan tài liệu
-    if doc.tables:
-        for tb in doc.tables:
-            for row in tb.rows:
-                left  = row.cells[0].text if len(row.cells) >= 1 else ""
-                right = row.cells[1].text if len(row.cells) >= 2 else ""
-
-                if left.strip():
-                    _scan_day_and_date(left)
-
-                for line in (l.strip() for l in right.split("\n")):
-                    if not line:
-                        continue
-                    m_tp = RE_TP.match(line)
-                    if m_tp:
-                        _flush_tp(m_tp.group(2))
-                        continue
-                    if _scan_day_and_date(line):
-                        continue
-                    _emit_event(line)
-
-
-    else:
-        for p in doc.paragraphs:
-            line = p.text.strip()
+    saw_table_row = False
+    for cells in table_rows:
+        saw_table_row = True
+        left  = cells[0] if len(cells) >= 1 else ""
+        right = cells[1] if len(cells) >= 2 else ""
+
+        if left.strip():
+            _scan_day_and_date(left)
+
+        for line in (l.strip() for l in right.split("\n")):
             if not line:
                 continue
             m_tp = RE_TP.match(line)
@@ -212,15 +295,30 @@ def parse_docx_as_table(path: str, default_year: Optional[int] = None) -> List[D
             if _scan_day_and_date(line):
                 continue
             _emit_event(line)
+            # có event mới hơn -> event trước không nhận thêm TP nữa, yield được
+            while len(pending) > 1:
+                out = _finalize(pending.pop(0))
+                if out:
+                    yield out
 
-    # Lọc rác & bổ sung DOW từ date nếu thiếu
-    events = [e for e in events if e.get("title") or e.get("start") or e.get("date")]
-    for e in events:
-        if not e.get("dow") and e.get("date"):
-            try:
-                d = dt.datetime.strptime(e["date"], "%d/%m/%Y").date()
-                e["dow"] = _dow_vi(d)
-            except Exception:
-                pass
+    if not saw_table_row:
+        for p in paragraphs:
+            line = p.strip()
+            if not line:
+                continue
+            m_tp = RE_TP.match(line)
+            if m_tp:
+                _flush_tp(m_tp.group(2))
+                continue
+            if _scan_day_and_date(line):
+                continue
+            _emit_event(line)
+            while len(pending) > 1:
+                out = _finalize(pending.pop(0))
+                if out:
+                    yield out
 
-    return events
\ No newline at end of file
+    for e in pending:
+        out = _finalize(e)
+        if out:
+            yield out
\ No newline at end of file
@@ -1,6 +1,7 @@
 # rag/textkit.py
 from __future__ import annotations
 import re
+from functools import lru_cache
 from typing import Dict, List, Optional
 
 # Regex & parsing
@@ -110,8 +111,13 @@ _DOW_MAP = {
     "chủ nhật": ["chủ nhật", "chu nhat", "cn"],
 }
 
+RE_WS = re.compile(r"\s+")
+
+@lru_cache(maxsize=2048)
 def _canon_dow(s: str) -> str:
-    q = re.sub(r"\s+", " ", (s or "").strip().lower())
+    # gọi lặp cho từng cặp (date, dow) mỗi query, đầu vào chỉ quanh quẩn
+    # "Thứ 2".."CN" -> memoize thay vì scan lại _DOW_MAP mỗi lần
+    q = RE_WS.sub(" ", (s or "").strip().lower())
     for canon, variants in _DOW_MAP.items():
         if any(q == v for v in variants) or any(v in q for v in variants):
             return canon
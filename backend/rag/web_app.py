@@ -7,7 +7,7 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from admin_api import router as admin_router
+from backend.api.admin_api import router as admin_router
 
 app = FastAPI(title="TMU Weekly Bot", version="1.0.0")
 